@@ -2,12 +2,22 @@ import os
 
 import uvicorn
 from fastapi import FastAPI, Depends
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, func
+from fastapi.responses import ORJSONResponse, Response
+from sqlalchemy import (create_engine, make_url, bindparam, delete, insert, inspect, select, text, Table, Column,
+                        ForeignKey, Integer, String, Date, DateTime, Time)
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, Session
-from apscheduler.schedulers.background import BackgroundScheduler
+from sqlalchemy.orm import sessionmaker, relationship, joinedload, raiseload
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+import redis.asyncio as redis
+import asyncio
 import random
 import datetime
+import json
+import hashlib
+import uuid
+from zoneinfo import ZoneInfo
 
 import logging
 
@@ -22,8 +32,26 @@ DATABASE_URL = os.getenv("DATABASE_URL")
 TODAY_CHOICES = "today_choices"
 FINAL_PLACE = "final_place"
 GATHERING_TIME = "gathering_time"
-engine = create_engine(DATABASE_URL)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "20"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "30"))
+engine = create_engine(
+    DATABASE_URL,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_pre_ping=True,  # Drop stale connections instead of failing the request
+    pool_recycle=1800,
+)
+# Sync engine is only used for schema creation and seeding
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# Async engine for request handlers so DB round-trips don't block the event loop
+async_engine = create_async_engine(
+    make_url(DATABASE_URL).set(drivername="postgresql+asyncpg"),
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_pre_ping=True,
+    pool_recycle=1800,
+)
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
 Base = declarative_base()
 
 
@@ -37,21 +65,67 @@ class Place(Base):
 class AvailableHour(Base):
     __tablename__ = "available_hours"
     id = Column(Integer, primary_key=True, index=True)
-    time = Column(String, unique=True, nullable=False)  # e.g., "18:00", "18:30", ...
+    time = Column(Time, unique=True, nullable=False)  # e.g., 18:00, 18:30, ...
+
+
+daily_selection_places = Table(
+    "daily_selection_places",
+    Base.metadata,
+    Column("selection_id", ForeignKey("daily_selection.id", ondelete="CASCADE"), primary_key=True),
+    Column("place_id", ForeignKey("places.id"), primary_key=True),
+)
 
 
 class DailySelection(Base):
     __tablename__ = "daily_selection"
     id = Column(Integer, primary_key=True, index=True)
-    date = Column(DateTime, default=datetime.date.today, unique=True)
-    places = Column(String)  # Comma-separated list of places
+    date = Column(Date, default=datetime.date.today, unique=True)
+    # A handful of places per day, so a JOIN in the same SELECT is cheapest
+    places = relationship("Place", secondary=daily_selection_places, lazy="joined")
     gathering_time = Column(DateTime, nullable=False)
     final_place = Column(String, nullable=True)
 
 
 Base.metadata.create_all(bind=engine)
 
-app = FastAPI()
+# Arbitrary key for the Postgres advisory lock held while migrating
+MIGRATION_LOCK_ID = 7212
+
+
+# create_all doesn't alter existing columns, so convert ones whose type changed in place
+def _migrate_column_type(conn, table, column, type_class, sql_type):
+    columns = {c["name"]: c["type"] for c in inspect(conn).get_columns(table)}
+    if isinstance(columns[column], type_class):
+        return
+    conn.execute(text(f"ALTER TABLE {table} ALTER COLUMN {column} TYPE {sql_type} USING {column}::{sql_type}"))
+
+
+# Moves the old comma-separated daily_selection.places column into the association table
+def _migrate_daily_selection_places(conn):
+    columns = {column["name"] for column in inspect(conn).get_columns("daily_selection")}
+    if "places" not in columns:
+        return
+    place_ids = dict(conn.execute(select(Place.name, Place.id)).all())
+    rows = conn.execute(text("SELECT id, places FROM daily_selection WHERE places IS NOT NULL")).all()
+    links = [{"selection_id": selection_id, "place_id": place_ids[name]}
+             for selection_id, names in rows for name in names.split(",") if name in place_ids]
+    if links:
+        conn.execute(insert(daily_selection_places), links)
+    conn.execute(text("ALTER TABLE daily_selection DROP COLUMN places"))
+
+
+""" Brings an existing database up to the current models. Idempotent, and safe to run from several workers at once."""
+def run_migrations():
+    with engine.begin() as conn:
+        conn.execute(text("SELECT pg_advisory_xact_lock(:id)"), {"id": MIGRATION_LOCK_ID})
+        _migrate_column_type(conn, "available_hours", "time", Time, "time")  # Was "HH:MM" strings
+        _migrate_column_type(conn, "daily_selection", "date", Date, "date")  # Was a midnight timestamp
+        _migrate_daily_selection_places(conn)
+
+
+run_migrations()
+
+app = FastAPI(default_response_class=ORJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -61,151 +135,267 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# In-memory cache
-CACHE = {TODAY_CHOICES: None, FINAL_PLACE: None, GATHERING_TIME: None}
-
-
-def get_db():
-    db = SessionLocal()
+# Secret mixed into the daily pick seed; set it to the same value on every worker
+# Falls back to a hash of DATABASE_URL: every worker shares it, and it isn't in the source
+PICK_SECRET = os.getenv("PICK_SECRET") or hashlib.sha256(DATABASE_URL.encode()).hexdigest()
+
+# Timezone the daily schedule runs in; unset means the server's local time
+APP_TIMEZONE = os.getenv("APP_TIMEZONE")
+TZ = ZoneInfo(APP_TIMEZONE) if APP_TIMEZONE else None
+
+# In-memory cache (L1), backed by Redis (L2) so it's shared across workers and survives restarts
+# _MISSING means "not loaded yet"; None is a known-empty value that L1 can answer without Redis
+_MISSING = object()
+CACHE = {TODAY_CHOICES: _MISSING, FINAL_PLACE: _MISSING, GATHERING_TIME: _MISSING}
+REDIS_URL = os.getenv("REDIS_URL")
+CACHE_TTL_SECONDS = 24 * 60 * 60
+CACHE_INVALIDATE_CHANNEL = "cache_invalidate"
+# Tags invalidation messages so a worker can ignore the ones it published itself
+WORKER_ID = uuid.uuid4().hex
+redis_client = redis.from_url(REDIS_URL, decode_responses=True) if REDIS_URL else None
+# Places and hours are seeded once, so they are loaded on startup instead of queried per pick
+PLACES_CACHE: list[Place] = []
+HOURS_CACHE: list[datetime.time] = []
+
+
+async def _cache_get(key):
+    if CACHE[key] is not _MISSING:
+        return CACHE[key]
+    if redis_client is None:
+        return
     try:
+        raw = await redis_client.get(key)
+    except Exception as e:
+        logger.error(f"Error reading {key} from Redis: {e}")
+        return
+    value = None
+    if raw is not None:
+        value = json.loads(raw)
+        if key == GATHERING_TIME:
+            value = datetime.datetime.fromisoformat(value)
+    CACHE[key] = value
+    return value
+
+async def _cache_set(key, value):
+    CACHE[key] = value
+    if redis_client is None:
+        return
+    try:
+        if value is None:
+            await redis_client.delete(key)
+        else:
+            raw = json.dumps(value.isoformat() if key == GATHERING_TIME else value)
+            await redis_client.setex(key, CACHE_TTL_SECONDS, raw)
+        # Other workers drop their L1 copy and re-read the new value from Redis
+        await redis_client.publish(CACHE_INVALIDATE_CHANNEL, f"{WORKER_ID}:{key}")
+    except Exception as e:
+        logger.error(f"Error writing {key} to Redis: {e}")
+
+async def _subscribe_invalidations():
+    while True:
+        try:
+            async with redis_client.pubsub() as pubsub:
+                await pubsub.subscribe(CACHE_INVALIDATE_CHANNEL)
+                async for message in pubsub.listen():
+                    if message["type"] != "message":
+                        continue
+                    sender, _, key = message["data"].partition(":")
+                    if sender != WORKER_ID and key in CACHE:
+                        CACHE[key] = _MISSING
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error listening for cache invalidations: {e}")
+            await asyncio.sleep(5)
+
+
+""" Current wall-clock time in TZ. Read once per request/job and passed down so a call can't straddle midnight."""
+def current_time() -> datetime.datetime:
+    # Stored datetimes are naive, so drop tzinfo to keep comparisons valid
+    return datetime.datetime.now(TZ).replace(tzinfo=None)
+
+
+async def get_db():
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 
-def get_available_places(db: Session):
+async def get_available_places(db: AsyncSession):
     try:
-        return [place.name for place in db.query(Place).all()]
+        return list(await db.scalars(select(Place).order_by(Place.id)))
     except Exception as e:
         logger.error(f"Error fetching places: {e}")
         return []
 
-def get_available_hours(db: Session):
+async def get_available_hours(db: AsyncSession):
     try:
-        return [hour.time for hour in db.query(AvailableHour).all()]
+        return list(await db.scalars(select(AvailableHour.time).order_by(AvailableHour.time)))
     except Exception as e:
         logger.error(f"Error fetching available hours: {e}")
         return []
 
-def get_today_selection(db: Session):
+""" Reloads the places and hours caches. Call again after writing to either table."""
+async def load_places_and_hours():
+    async with AsyncSessionLocal() as db:
+        PLACES_CACHE[:] = await get_available_places(db)
+        HOURS_CACHE[:] = await get_available_hours(db)
+    logger.info(f"Loaded {len(PLACES_CACHE)} places and {len(HOURS_CACHE)} available hours.")
+
+# Built once at import so each lookup only binds the date. Compares the bare column so the
+# unique index on date can be used.
+_TODAY_STMT = (select(DailySelection)
+               .where(DailySelection.date == bindparam("today"))
+               # Any relationship not loaded up front raises instead of issuing a hidden per-row SELECT
+               .options(joinedload(DailySelection.places), raiseload("*")))
+
+async def get_today_selection(db: AsyncSession, today: datetime.date):
     try:
-        return db.query(DailySelection).filter(
-            func.date(DailySelection.date) == datetime.date.today()).first()
+        return (await db.execute(_TODAY_STMT, {"today": today})).unique().scalar_one_or_none()
     except Exception as e:
         logger.error(f"Error fetching today's selection: {e}")
         return
 
 """ Picks 3-5 random places and a gathering time, stores in the cache and database."""
-def pick_places():
-    db = next(get_db())
-    try:
-        selected_places, gathering_time = _pick_place_and_time(*_get_available_places_and_hours(db))
-        _store_in_cache(selected_places, gathering_time)
-        _store_in_db(db, selected_places, gathering_time)
-    except Exception as e:
-        logger.error(f"Error selecting places: {e}")
-    finally:
-        db.close()
-
-def _get_available_places_and_hours(db):
-    available_places = get_available_places(db)
-    available_hours = get_available_hours(db)
-    if not available_places or not available_hours:
+async def pick_places():
+    today = current_time().date()
+    if not PLACES_CACHE or not HOURS_CACHE:
+        # Startup load may have failed or run before seeding; retry before giving up
+        await load_places_and_hours()
+    async with AsyncSessionLocal() as db:
+        try:
+            selected_places, gathering_time = _pick_place_and_time(today, *_get_available_places_and_hours())
+            gathering_time = datetime.datetime.combine(today, gathering_time)
+            await _store_in_cache([place.name for place in selected_places], gathering_time)
+            await _cache_set(FINAL_PLACE, None)
+            await _store_in_db(db, today, selected_places, gathering_time)
+        except Exception as e:
+            logger.error(f"Error selecting places: {e}")
+
+def _get_available_places_and_hours():
+    if not PLACES_CACHE or not HOURS_CACHE:
         logger.error("No places or available hours found.")
         return
-    return available_places, available_hours
+    return PLACES_CACHE, HOURS_CACHE
+
+# Seeded by a secret and the date so every worker, and any re-run of a job, makes the same picks for the day
+# without them being predictable from the source. Each stream gets its own seed so draws don't repeat.
+def _rng_for(today, stream):
+    return random.Random(f"{PICK_SECRET}:{today.isoformat()}:{stream}")
 
-def _pick_place_and_time(available_places, available_hours):
-    num_places = random.randint(3, 5)
-    selected_places = random.sample(available_places, num_places)
-    gathering_time_str = random.choice(available_hours)
-    gathering_time = datetime.datetime.strptime(gathering_time_str, "%H:%M").time()
+def _pick_place_and_time(today, available_places, available_hours):
+    rng = _rng_for(today, "pick")
+    num_places = rng.randint(3, 5)
+    selected_places = rng.sample(available_places, num_places)
+    gathering_time = rng.choice(available_hours)
 
-    logger.info(f"Selected places for today: {selected_places}")
+    logger.info(f"Selected places for today: {[place.name for place in selected_places]}")
     logger.info(f"Selected gathering time for today: {gathering_time}")
 
     return selected_places, gathering_time
 
-def _store_in_cache(selected_places, gathering_time):
-    CACHE[TODAY_CHOICES] = selected_places
-    CACHE[GATHERING_TIME] = gathering_time
-
-def _store_in_db(db, selected_places, gathering_time):
-    selection = DailySelection(
-        places=",".join(selected_places),
-        gathering_time=datetime.datetime.combine(datetime.date.today(), gathering_time)
+async def _store_in_cache(selected_places, gathering_time):
+    await _cache_set(TODAY_CHOICES, selected_places)
+    await _cache_set(GATHERING_TIME, gathering_time)
+
+async def _store_in_db(db, today, selected_places, gathering_time):
+    # Upsert on date so a re-run or a second worker overwrites today's row in one round-trip
+    stmt = pg_insert(DailySelection).values(date=today, gathering_time=gathering_time)
+    selection_id = await db.scalar(
+        stmt.on_conflict_do_update(
+            index_elements=["date"],
+            # The place links are replaced below, so a previous final place may no longer be among them
+            set_={"gathering_time": stmt.excluded.gathering_time, "final_place": None},
+        )
+        .returning(DailySelection.id)
     )
-    db.add(selection)
-    db.commit()
-    db.refresh(selection)
-    db.close()
+    await db.execute(delete(daily_selection_places).where(daily_selection_places.c.selection_id == selection_id))
+    # Link by id so the detached cached Place objects don't need to be merged into this session
+    await db.execute(insert(daily_selection_places),
+                     [{"selection_id": selection_id, "place_id": place.id} for place in selected_places])
+    await db.commit()
 
 """ Picks a final place 2 hours before the gathering time and updates the DB and cache."""
-def pick_final_place():
-    if CACHE[FINAL_PLACE]:
+async def pick_final_place():
+    if await _cache_get(FINAL_PLACE):
         logger.info("Final place already selected.")
         return
 
-    db = next(get_db())
-    selected_places, gathering_time = CACHE[TODAY_CHOICES], CACHE[GATHERING_TIME]
-    if not (selected_places and gathering_time):
-        selected_places, gathering_time = _get_places_and_gathering_time_from_db(db)
-        _store_in_cache(selected_places, gathering_time)
-    if not (selected_places and gathering_time):
-        logger.error("Error getting today's selections")
-        db.close()
-        return
+    now = current_time()
+    async with AsyncSessionLocal() as db:
+        selected_places, gathering_time = await _cache_get(TODAY_CHOICES), await _cache_get(GATHERING_TIME)
+        if not (selected_places and gathering_time):
+            selected_places, gathering_time = _places_and_gathering_time(await get_today_selection(db, now.date()))
+            if selected_places and gathering_time:
+                await _store_in_cache(selected_places, gathering_time)
+        if not (selected_places and gathering_time):
+            logger.error("Error getting today's selections")
+            return
 
-    if _is_within_two_hours_from_now(gathering_time):
-        _set_final_place(db, selected_places)
+        if _is_within_two_hours_from_now(gathering_time, now):
+            await _set_final_place(db, now.date(), selected_places)
 
-def _get_places_and_gathering_time_from_db(db):
-    try:
-        today_selection = get_today_selection(db)
-        if not today_selection:
-            logger.error("No daily selection found in DB.")
-            return
-        return today_selection.places.split(","), today_selection.gathering_time
-    except Exception as e:
-        logger.error(f"Error getting today's selection: {e}")
-        return
+def _places_and_gathering_time(today_selection):
+    if not today_selection:
+        logger.error("No daily selection found in DB.")
+        return None, None
+    return [place.name for place in today_selection.places], today_selection.gathering_time
 
-def _set_final_place(db, selected_places):
+async def _set_final_place(db, today, selected_places):
     try:
-        final_place = random.choice(selected_places)
+        # Sorted so the pick doesn't depend on whether the list came from the cache or the DB
+        final_place = _rng_for(today, "final").choice(sorted(selected_places))
         logger.info(f"Final place selected: {final_place}")
-        CACHE[FINAL_PLACE] = final_place
-        today_selection = get_today_selection(db)
+        await _cache_set(FINAL_PLACE, final_place)
+        today_selection = await get_today_selection(db, today)
         if today_selection:
             today_selection.final_place = final_place
-            db.commit()
-            db.refresh(today_selection)
+            await db.commit()
         else:
             logger.error(f"Error setting final place to database")
     except Exception as e:
         logger.error(f"Error setting final place to database: {e}")
-    finally:
-        db.close()
 
 
-def _is_within_two_hours_from_now(gathering_time):
-    current_datetime = datetime.datetime.now()
-    time_difference = gathering_time - current_datetime
-    print(time_difference.total_seconds())
+def _is_within_two_hours_from_now(gathering_time, now):
+    time_difference = gathering_time - now
     return time_difference.total_seconds() <= 2 * 60 * 60
 
-scheduler = BackgroundScheduler()
+# Runs jobs on the app's event loop so they share the async pool with request handlers
+scheduler = AsyncIOScheduler(timezone=TZ)
 scheduler.add_job(pick_places, "cron", hour=0, minute=0)  # Pick new places and time every midnight
 scheduler.add_job(pick_final_place, "interval", minutes=15)  # Check every 15 minutes to pick the final place
-scheduler.start()
+
+invalidation_task = None
+
+@app.on_event("startup")
+async def startup():
+    global invalidation_task
+    await load_places_and_hours()
+    scheduler.start()
+    if redis_client is not None:
+        invalidation_task = asyncio.create_task(_subscribe_invalidations())
+
+@app.on_event("shutdown")
+async def shutdown():
+    scheduler.shutdown()
+    if invalidation_task is not None:
+        invalidation_task.cancel()
+    if redis_client is not None:
+        await redis_client.aclose()
 
 """ Returns the daily selected places, gathering time, and final place if selected."""
 @app.get("/choices")
-def get_choices(db: Session = Depends(get_db)):
-    selected_places, gathering_time = CACHE[TODAY_CHOICES], CACHE[GATHERING_TIME]
+async def get_choices(db: AsyncSession = Depends(get_db)):
+    now = current_time()
+    # Fetched at most once per request and reused for every field below
+    today_selection = None
+    selected_places, gathering_time = await _cache_get(TODAY_CHOICES), await _cache_get(GATHERING_TIME)
     if not (selected_places and gathering_time):
-        selected_places, gathering_time = _get_places_and_gathering_time_from_db(db)
-        _store_in_cache(selected_places, gathering_time)
+        today_selection = await get_today_selection(db, now.date())
+        selected_places, gathering_time = _places_and_gathering_time(today_selection)
+        # Don't wipe the shared cache on a miss or a swallowed DB error
+        if selected_places and gathering_time:
+            await _store_in_cache(selected_places, gathering_time)
     if not (selected_places and gathering_time):
         return {"message": "No selection made yet."}
     response = {
@@ -214,21 +404,25 @@ def get_choices(db: Session = Depends(get_db)):
     }
 
     # Check if final place is selected
-    if CACHE[FINAL_PLACE]:
-        response[FINAL_PLACE] = CACHE[FINAL_PLACE]
+    final_place = await _cache_get(FINAL_PLACE)
+    if final_place:
+        response[FINAL_PLACE] = final_place
     else:
-        if _is_within_two_hours_from_now(gathering_time):
-            # Unoptimized DB query. We should not re-query the db if we already did above.
-            # But that requires a bit of refactor
-            today_selection = get_today_selection(db)
+        if _is_within_two_hours_from_now(gathering_time, now):
+            if today_selection is None:
+                today_selection = await get_today_selection(db, now.date())
             if today_selection and today_selection.final_place:
                 response[FINAL_PLACE] = today_selection.final_place
-                CACHE[FINAL_PLACE] = today_selection.final_place
-    return response
+                await _cache_set(FINAL_PLACE, today_selection.final_place)
+    # Returned directly so orjson serializes gathering_time itself instead of jsonable_encoder
+    return ORJSONResponse(response)
+
+# Built once; probes hit this constantly and nothing in it changes
+HEALTH_OK = Response(b'{"status":"healthy"}', media_type="application/json")
 
 @app.get("/healthz")
-def health_check():
-    return {"status": "healthy", "timestamp": datetime.datetime.utcnow()}
+async def health_check():
+    return HEALTH_OK
 
 if __name__ == "__main__":
     uvicorn.run(app, reload=False, log_level=logging.INFO)
\ No newline at end of file
@@ -1,19 +1,11 @@
-import os
-
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
 from datetime import datetime
 import random
 import datetime
 
-from app import Base, Place, AvailableHour, DailySelection
-
-# SQLite database URL
-DATABASE_URL = os.getenv("DATABASE_URL")
+from sqlalchemy import insert, select, exists
 
-# Create engine and session
-engine = create_engine(DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# Reuse the app's engine and session factory so seeding shares the same pool settings
+from app import Base, Place, AvailableHour, DailySelection, engine, SessionLocal
 
 # Sample data for seeding
 places = [
@@ -31,9 +23,14 @@ places = [
 ]
 
 available_hours = [
-    "18:00", "18:30", "19:00", "19:30", "20:00", "20:30", "21:00"
+    datetime.time(18, 0), datetime.time(18, 30), datetime.time(19, 0), datetime.time(19, 30),
+    datetime.time(20, 0), datetime.time(20, 30), datetime.time(21, 0)
 ]
 
+# EXISTS stops at the first row instead of counting the whole table
+def _has_rows(db, model):
+    return db.execute(select(exists().select_from(model))).scalar()
+
 # Function to seed the database
 def seed_db():
     db = SessionLocal()
@@ -43,32 +40,26 @@ def seed_db():
         Base.metadata.create_all(bind=engine)  # This creates the tables
 
         # Seed Places
-        if db.query(Place).count() == 0:  # Check if the table is empty
-            for place in places:
-                new_place = Place(name=place)
-                db.add(new_place)
+        if not _has_rows(db, Place):  # Check if the table is empty
+            db.execute(insert(Place), [{"name": place} for place in places])  # Single executemany
             db.commit()  # Commit the transaction
 
         # Seed Available Hours
-        if db.query(AvailableHour).count() == 0:  # Check if the table is empty
-            for hour in available_hours:
-                new_hour = AvailableHour(time=hour)
-                db.add(new_hour)
+        if not _has_rows(db, AvailableHour):  # Check if the table is empty
+            db.execute(insert(AvailableHour), [{"time": hour} for hour in available_hours])
             db.commit()  # Commit the transaction
 
         # Seed Daily Selection (for today)
-        if db.query(DailySelection).count() == 0:  # Check if the table is empty
-            selected_places = random.sample(places, random.randint(3, 5))  # Pick 3-5 random places
-            gathering_time_str = random.choice(available_hours)  # Pick a random gathering time
-
-            # Convert gathering_time_str to a time object
-            gathering_time = datetime.datetime.strptime(gathering_time_str, "%H:%M").time()
+        if not _has_rows(db, DailySelection):  # Check if the table is empty
+            all_places = db.scalars(select(Place)).all()
+            selected_places = random.sample(all_places, random.randint(3, 5))  # Pick 3-5 random places
+            gathering_time = random.choice(available_hours)  # Pick a random gathering time
             gathering_datetime = datetime.datetime.combine(datetime.date.today(), gathering_time)
 
             # Create the selection for today
             new_selection = DailySelection(
                 date=datetime.date.today(),  # Use today's date as a datetime.date object
-                places=",".join(selected_places),  # Comma-separated list of places
+                places=selected_places,
                 gathering_time=gathering_datetime  # Use the time object for gathering time
             )
             db.add(new_selection)